@@ -15,65 +15,111 @@ transformations - to create new features. Feature engineering allows us to combi
 across many tables into a single dataframe that we can then use for machine learning model training.
 Finally, the next step after creating all of these features is figuring out which ones are
 important.
+
+Run the script with 'python feature_engineering.py' to print the generated feature matrix, or add
+the '--debug' flag to also print the intermediate dataframes, the entity set and example features.
+The functions below can also be imported to build the entity set and run deep feature synthesis
+from other code without printing anything.
 '''
 
-# Run this if featuretools is not already installed
-# !pip install -U featuretools
+# Run this if featuretools, pyarrow, polars or joblib are not already installed
+# !pip install -U featuretools pyarrow polars joblib
 
 
 # =============================== LIBRARIES =======================================================
 # pandas and numpy for data manipulation
 import pandas as pd
 import numpy as np
+# pyarrow for fast, multithreaded reading of the csv files
+import pyarrow as pa
+from pyarrow import csv
+# polars for lazy, multithreaded manual feature engineering
+import polars as pl
 # featuretools for automated feature engineering
 import featuretools as ft
-# ignore warnings from pandas
+# argparse for the command line interface
+import argparse
+# hashlib and os for caching the results of deep feature synthesis
+import hashlib
+import os
+# joblib for optionally running the deep feature synthesis calls in parallel processes (--n-jobs)
+from joblib import Parallel, delayed
+# warnings for ignoring the warnings from pandas when the script is run
 import warnings
-warnings.filterwarnings('ignore')
 
 
 # =============================== READ DATA ========================================================
 
 # Read in the data
-# 'parse_dates' recogenize the date
-clients = pd.read_csv('data/clients.csv', parse_dates=['joined'])
-loans = pd.read_csv('data/loans.csv', parse_dates=['loan_start', 'loan_end'])
-payments = pd.read_csv('data/payments.csv', parse_dates=['payment_date'])
-
-
-# =============================== READ DATA ========================================================
-
-# method 'head' show to 5 positions of the dataset
-print(clients.head())
-# method 'sample' show ranodm n raws of the dataset
-loans.sample(10)
-payments.sample(10)
+# pyarrow splits every file into blocks which are parsed in parallel threads, and the columns are
+# stored in a columnar format instead of python objects. All dates in the data are written as
+# YYYY-MM-DD, so the date columns are parsed only with the built-in ISO 8601 parser of pyarrow,
+# which is much faster than trying a strptime format (or guessing the format) for every value.
+def read_csv(path, date_columns=()):
+    read_options = csv.ReadOptions(use_threads=True, block_size=8 << 20)
+    convert_options = csv.ConvertOptions(
+        column_types={column: pa.timestamp('ns') for column in date_columns},
+        timestamp_parsers=[csv.ISO8601])
+    table = csv.read_csv(path, read_options=read_options, convert_options=convert_options)
+    # featuretools works on plain pandas dataframes, so the table is converted to numpy columns
+    df = table.to_pandas()
+    # ids, amounts and scores fit in smaller types than the default int64 and float64, which
+    # halves (or better) the memory that the aggregations of featuretools have to go through
+    for column in df.select_dtypes('int64'):
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+    for column in df.select_dtypes('float64'):
+        df[column] = pd.to_numeric(df[column], downcast='float')
+    return df
+
+
+# the data (and the cache below) are found next to this file, so the functions can be used from
+# any working directory
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+
+
+def load_data():
+    clients = read_csv(os.path.join(DATA_DIR, 'clients.csv'), date_columns=['joined'])
+    loans = read_csv(os.path.join(DATA_DIR, 'loans.csv'), date_columns=['loan_start', 'loan_end'])
+    payments = read_csv(os.path.join(DATA_DIR, 'payments.csv'), date_columns=['payment_date'])
+    return clients, loans, payments
 
 
 # =============================== MANUAL FEATURE ENIGNEERING =======================================
 
-# Create a month column
-clients['join_month'] = clients['joined'].dt.month
-
-# Create a log of income column
-clients['log_income'] = np.log(clients['income'])
+# The manual features are written as one lazy polars query: nothing is computed until the query
+# is collected, so polars can fuse the column expressions, the aggregation and the join into a
+# single parallel pass over the data instead of materializing every intermediate dataframe.
 
-print(clients.head())
-
-# To incorporate information about the other tables, we use the df.groupby method, followed by
-# a suitable aggregation function, followed by df.merge.
+# To incorporate information about the other tables, we group the child table with the group_by
+# method of polars, followed by a suitable aggregation function, followed by a join back onto the
+# parent table.
 # For example, let's calculate the average, minimum, and maximum amount of previous loans for each
 # client. In the terms of featuretools, this would be considered an aggregation feature primitive
 # because we using multiple tables in a one-to-many relationship to calculate aggregation figures.
 
-# Groupby client id and calculate mean, max, min previous loan size
-stats = loans.groupby('client_id')['loan_amount'].agg(['mean', 'max', 'min'])
-stats.columns = ['mean_loan_amount', 'max_loan_amount', 'min_loan_amount']
-print(stats.head())
+def manual_features(clients, loans):
+    # Create a month column and a log of income column
+    # (the log is taken in float32, like the other downcast columns, so twice as many values fit
+    # into one vectorized instruction)
+    clients_query = pl.from_pandas(clients).lazy().with_columns([
+        pl.col('joined').dt.month().alias('join_month'),
+        pl.col('income').cast(pl.Float32).log().alias('log_income')])
+
+    # Groupby client id and calculate mean, max, min previous loan size
+    stats_query = pl.from_pandas(loans).lazy().group_by('client_id').agg([
+        pl.col('loan_amount').mean().alias('mean_loan_amount'),
+        pl.col('loan_amount').max().alias('max_loan_amount'),
+        pl.col('loan_amount').min().alias('min_loan_amount')])
+
+    # Merge with clients dataframe (keeping the order of the clients, like a pandas left merge)
+    merged_query = clients_query.join(stats_query, on='client_id', how='left',
+                                      maintain_order='left')
 
-# Merge with clients dataframe
-clients.merge(stats, left_on='client_id', right_index=True, how='left').head(10)
-print(clients.head(10))
+    # Run all three queries at once, the shared parts of the plans are computed only one time
+    clients, stats, merged = [frame.to_pandas() for frame in
+                              pl.collect_all([clients_query, stats_query, merged_query])]
+    return clients, stats.set_index('client_id').sort_index(), merged
 
 
 # =================================================================================================
@@ -104,31 +150,58 @@ print(clients.head(10))
 # discrete values. This is done using an integer with the variables as keys and the feature types
 # as values.
 
-# Create new EntitySet
-es = ft.EntitySet(id='clients')
-
-# Create an entity from the client DataFrame
-# This dataframe already has an index and a time index
-es = es.entity_from_dataframe(entity_id='clients', dataframe=clients, index='client_id',
-                              time_index='joined')
-# Create an entity from the loans DataFrame
-# This DataFrame already has an index and a time index
-es = es.entity_from_dataframe(entity_id='loans', dataframe=loans,
-                              variable_types={'repaid': ft.variable_types.Categorical},
-                              index='loan_id', time_index='loan_start')
-# Create an entity from the payments DataFrame
-# This does not yet have a unique index
-es = es.entity_from_dataframe(entity_id='payments', dataframe=payments,
-                              variable_types={'missed': ft.variable_types.Categorical},
-                              make_index=True, index='payment_id', time_index='payment_date')
-
-# Summary of the entity with the data.
-# All three entities have been successfully added to the EntitySet
-print(es)
-
-# We can access any of the entities using Python dictionary syntax.
-print(es['loans'])
-print(es['payments'])
+def build_entityset(clients, loans, payments):
+    # The ids which link the tables together are converted to categoricals. Every id is then stored
+    # as an integer code into one shared list of categories, so the groupby and merge operations
+    # inside featuretools work on the precomputed codes instead of hashing the raw ids again. Both
+    # sides of a relationship must use the same categories for the codes to match. The categories
+    # are sorted, so the order of the codes is the order of the ids and sorting by an id column
+    # gives the same order as sorting the plain integer ids.
+    client_ids = pd.CategoricalDtype(np.sort(clients['client_id'].unique()))
+    loan_ids = pd.CategoricalDtype(np.sort(loans['loan_id'].unique()))
+    clients = clients.astype({'client_id': client_ids})
+    loans = loans.astype({'client_id': client_ids, 'loan_id': loan_ids})
+    payments = payments.astype({'loan_id': loan_ids})
+    # An id of a child which is missing from its parent is not one of the categories and would
+    # silently become NaN, so such rows are reported instead.
+    for name, df, column in [('loans', loans, 'client_id'), ('payments', payments, 'loan_id')]:
+        if df[column].isna().any():
+            raise ValueError('{} has {} rows with a {} that does not exist in the parent table'
+                             .format(name, df[column].isna().sum(), column))
+
+    # The payments do not have a unique index yet. Instead of letting featuretools make one, the
+    # payment_id column is created directly as a range of int32 numbers, numbered in the order of
+    # the rows in the file like the index that make_index=True would create.
+    payments['payment_id'] = np.arange(len(payments), dtype=np.int32)
+
+    # Featuretools keeps every entity sorted by its time index (and then by its index). The
+    # dataframes are sorted in this order once here, so featuretools can skip its own sort with
+    # already_sorted.
+    clients = clients.sort_values(['joined', 'client_id'])
+    loans = loans.sort_values(['loan_start', 'loan_id'])
+    payments = payments.sort_values(['payment_date', 'payment_id'])
+
+    # Create new EntitySet
+    es = ft.EntitySet(id='clients')
+
+    # Create an entity from the client DataFrame
+    # This dataframe already has an index and a time index
+    es = es.entity_from_dataframe(entity_id='clients', dataframe=clients, index='client_id',
+                                  time_index='joined', already_sorted=True)
+    # Create an entity from the loans DataFrame
+    # This DataFrame already has an index and a time index
+    es = es.entity_from_dataframe(entity_id='loans', dataframe=loans,
+                                  variable_types={'repaid': ft.variable_types.Categorical},
+                                  index='loan_id', time_index='loan_start', already_sorted=True)
+    # Create an entity from the payments DataFrame
+    # This DataFrame has the payment_id index created above and a time index
+    es = es.entity_from_dataframe(entity_id='payments', dataframe=payments,
+                                  variable_types={'missed': ft.variable_types.Categorical},
+                                  index='payment_id', time_index='payment_date',
+                                  already_sorted=True)
+
+    # The entities are linked together in the RELATIONSHIPS section below
+    return add_relationships(es)
 
 
 # ==================================== RELATIONSHIPS ===============================================
@@ -152,23 +225,66 @@ print(es['payments'])
 
 
 # We codify relationships in the language of featuretools by specifying the parent variable and
-# then the child variable. After creating a relationship, we add it to the EntitySet.
+# then the child variable. After creating the relationships, we add them to the EntitySet.
+
+def add_relationships(es):
+    # Relationship between clients and previous loans
+    r_client_previous = ft.Relationship(es['clients']['client_id'], es['loans']['client_id'])
+
+    # The second relationship is between the loans and payments. These two entities are related by
+    # the loan_id variable.
 
-# Relationship between clients and previous loans
-r_client_previous = ft.Relationship(es['clients']['client_id'], es['loans']['client_id'])
-# Add the realtionship to the entity set
-es = es.add_relationship(r_client_previous)
+    # Relationship between previous loans and previous payments
+    r_payments = ft.Relationship(es['loans']['loan_id'], es['payments']['loan_id'])
 
+    # Add both relationships to the entity set with a single call
+    return es.add_relationships([r_client_previous, r_payments])
 
-# The relationship has now been stored in the entity set. The second relationship is between
-# the loans and payments. These two entities are related by the loan_id variable.
 
-# Relationship between previous loans and previous payments
-r_payments = ft.Relationship(es['loans']['loan_id'], es['payments']['loan_id'])
-# Add relationship to the entity set
-es = es.add_relationship(r_payments)
+# ==================================== CACHE =======================================================
 
-print(es)
+# Deep feature synthesis is the slowest part of this script. Its result depends only on the
+# entity set it runs on, on the arguments of the ft.dfs call and on the featuretools version, so
+# all of them are hashed into a key and the feature matrix and feature definitions are saved under
+# 'cache/<key>/'. The entity set is hashed by its contents (data, dtypes, variable types and
+# relationships), so any change to the data or to the way the entities are built invalidates the
+# cache. When the script is run again without such a change, the results are loaded from disk
+# instead of being calculated again.
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+
+
+def hash_entityset(es, key):
+    for entity in es.entities:
+        key.update(entity.id.encode())
+        key.update(pd.util.hash_pandas_object(entity.df).values.tobytes())
+        key.update(repr(entity.df.dtypes.to_dict()).encode())
+        key.update(repr([(variable.id, type(variable).__name__)
+                         for variable in entity.variables]).encode())
+    key.update(repr(es.relationships).encode())
+
+
+def cached_dfs(**kwargs):
+    key = hashlib.blake2b(digest_size=16)
+    key.update(ft.__version__.encode())
+    hash_entityset(kwargs['entityset'], key)
+    key.update(repr(sorted((name, value) for name, value in kwargs.items()
+                           if name != 'entityset')).encode())
+
+    directory = os.path.join(CACHE_DIR, key.hexdigest())
+    matrix_path = os.path.join(directory, 'features.parquet')
+    definitions_path = os.path.join(directory, 'features.json')
+    if os.path.exists(matrix_path) and os.path.exists(definitions_path):
+        return pd.read_parquet(matrix_path), ft.load_features(definitions_path)
+
+    features, feature_defs = ft.dfs(**kwargs)
+    # the ids are categoricals inside the entity set (see ENTITES), but the feature matrix is
+    # indexed by the plain ids again
+    if isinstance(features.index.dtype, pd.CategoricalDtype):
+        features.index = features.index.astype(features.index.categories.dtype)
+    os.makedirs(directory, exist_ok=True)
+    features.to_parquet(matrix_path, compression='zstd')
+    ft.save_features(feature_defs, definitions_path)
+    return features, feature_defs
 
 
 # ==================================== FUTURE PRIMITIVES ===========================================
@@ -184,11 +300,9 @@ print(es)
 # would be extracting the day from dates, or finiding the difference between two columns in one
 # table.
 
-# present list of primitives
-primitives = ft.list_primitives()
-pd.options.display.max_colwidth = 100
-primitives[primitives['type'] == 'aggregation'].head(10)
-primitives[primitives['type'] == 'transform'].head(10)
+# The full list of available primitives (with their type and description) is returned by
+# ft.list_primitives(). It is only built in the --debug mode (see DEMO below), because it has to
+# scan the whole primitive registry and this script only uses the primitives named below.
 
 
 # In featuretools it is also possible to create your own primitives.
@@ -197,14 +311,31 @@ primitives[primitives['type'] == 'transform'].head(10)
 # agg_primitives which are the aggregation feature primitives; and the trans_primitives which are
 # transformation primitives to apply.
 
-# Create new features using specified primitives
-features, feature_names = ft.dfs(entityset=es, target_entity='clients',
-                                 agg_primitives=['mean', 'max', 'percent_true', 'last'],
-                                 trans_primitives=['years', 'month', 'subtract', 'divide'])
-
-pd.DataFrame(features['MONTH(joined)'].head())
-pd.DataFrame(features['MEAN(payments.payment_amount)'].head())
-features.head()
+def _dfs_worker(**kwargs):
+    # the joblib worker processes do not inherit the warning filter of main(), so the warnings are
+    # ignored here for the duration of the call only (whether it runs in a worker or, with
+    # n_jobs=1, in the calling process)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return cached_dfs(**kwargs)
+
+
+def run_dfs(es, n_jobs=1):
+    # Create new features using specified primitives
+    # (the result is cached on disk, see the CACHE section above)
+    # A single ft.dfs call runs on one core. The automated deep feature synthesis (see AUTOMATED
+    # DEEP FEATURE SYNTHESIS below) does not depend on this call, so with n_jobs=2 both of them are
+    # started at the same time in two worker processes. Starting the workers and copying the entity
+    # set into each of them takes longer than the calls themselves on the small example data, so
+    # by default they run one after the other in the current process.
+    # Returns the pairs (feature matrix, feature definitions) of both calls.
+    return Parallel(n_jobs=n_jobs)([
+        delayed(_dfs_worker)(entityset=es, target_entity='clients',
+                             agg_primitives=['mean', 'max', 'percent_true', 'last'],
+                             trans_primitives=['years', 'month', 'subtract', 'divide']),
+        delayed(_dfs_worker)(entityset=es, target_entity='clients', max_depth=2,
+                             ignore_variables={'loans': ['loan_end']},
+                             drop_contains=['SKEW', 'STD'])])
 
 
 # ================================= DEEP FEATURE SYNTHESIS =========================================
@@ -220,16 +351,12 @@ features.head()
 # the MEAN(loans.loan_amount) feature has a depth of 1 because it is made by applying a single
 # aggregation primitive. This feature represents the average size of a client's previous loans.
 
-# show a feature with a depth of 1
-pd.DataFrame(features['MEAN(loans.loan_amount)'].head(10))
-
 # As well scroll through the features, we see a number of features with a depth of 2. For example,
 # the LAST(loans.(MEAN(payments.payment_amount))) has depth = 2 because it is made by stacking two
 # feature primitives, first an aggregation and then a transformation. This feature represents
 # the average payment amount for the last (most recent) loan for each client.
 
-# Show a feature with depth of 2
-pd.DataFrame(features['LAST(loans.MEAN(payments.payment_amount))'].head(10))
+# Both features are shown in the --debug mode (see DEMO below).
 
 # We can create features of arbitrary depth by stacking more primitives. However, it is important to
 # consider the fact that primitives with depth more than 2 become very convoluted to understand.
@@ -243,11 +370,16 @@ pd.DataFrame(features['LAST(loans.MEAN(payments.payment_amount))'].head(10))
 # featuretools will automatically try many all combinations of feature primitives to the ordered
 # depth
 
-# perform deep feature synthesis without specifying primitives
-features, feature_name = ft.dfs(entityset=es, target_entity='clients', max_depth=2)
-features.iloc[:, 4:].head()
+# Every combination costs one more aggregation over the child tables, so the search space is
+# pruned before anything is calculated: ignore_variables leaves out the loan_end column (it is only
+# known once a loan is finished) and drop_contains skips all features built on the SKEW and STD
+# primitives, including the deeper features stacked on top of them.
+
+# Deep feature synthesis without specifying primitives is the second ft.dfs call in run_dfs. By
+# default it is calculated after the first one; with --n-jobs 2 (n_jobs=2 in run_dfs) both are
+# calculated in parallel (see FUTURE PRIMITIVES).
 
-# Deep feature synthesis has created 90 new features out of the existing data! While we could have
+# Deep feature synthesis has created 68 new features out of the existing data! While we could have
 # created all of these manually, I am glad to not have to write all that code by hand. The primary
 # benefit of featuretools is that it creates features without any subjective human biases. Even a
 # human with considerable domain knowledge will be limited by their imagination when making new
@@ -257,3 +389,73 @@ features.iloc[:, 4:].head()
 # completely because a human can still use domain knowledge and machine learning expertise to
 # select the most important features or build new features from those suggested by automated deep
 # feature synthesis.
+
+
+# ==================================== DEMO ========================================================
+
+# Printing the intermediate results is only needed to follow the tutorial, so it is done only when
+# the script is run with the --debug flag and never when the module is imported.
+def _demo(clients, loans, payments, stats, merged, es, features):
+    # method 'head' show to 5 positions of the dataset
+    # (clients already has the manual join_month and log_income columns)
+    print(clients.head())
+    # method 'sample' show ranodm n raws of the dataset
+    print(loans.sample(10))
+    print(payments.sample(10))
+
+    # the manual features, the loan statistics and their merge with the clients dataframe
+    print(stats.head())
+    print(merged.head(10))
+
+    # Summary of the entity with the data.
+    # All three entities have been successfully added to the EntitySet
+    print(es)
+    # We can access any of the entities using Python dictionary syntax.
+    print(es['loans'])
+    print(es['payments'])
+
+    # present list of primitives
+    primitives = ft.list_primitives()
+    pd.options.display.max_colwidth = 100
+    print(primitives[primitives['type'] == 'aggregation'].head(10))
+    print(primitives[primitives['type'] == 'transform'].head(10))
+
+    # features created using specified primitives
+    print(pd.DataFrame(features['MONTH(joined)'].head()))
+    print(pd.DataFrame(features['MEAN(payments.payment_amount)'].head()))
+    print(features.head())
+    # show a feature with a depth of 1
+    print(pd.DataFrame(features['MEAN(loans.loan_amount)'].head(10)))
+    # Show a feature with depth of 2
+    print(pd.DataFrame(features['LAST(loans.MEAN(payments.payment_amount))'].head(10)))
+
+
+# ==================================== MAIN ========================================================
+
+def main():
+    # ignore warnings from pandas (only when run as a script, importing the module leaves the
+    # warning filters alone)
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Automated feature engineering with featuretools.')
+    parser.add_argument('--debug', action='store_true',
+                        help='print the intermediate dataframes, the entity set and example '
+                             'features')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='number of worker processes for deep feature synthesis (use 2 to run '
+                             'both ft.dfs calls in parallel)')
+    args = parser.parse_args()
+
+    clients, loans, payments = load_data()
+    clients, stats, merged = manual_features(clients, loans)
+    es = build_entityset(clients, loans, payments)
+    (features, _), (auto_features, _) = run_dfs(es, n_jobs=args.n_jobs)
+
+    if args.debug:
+        _demo(clients, loans, payments, stats, merged, es, features)
+    # the new features created by the automated deep feature synthesis
+    print(auto_features.iloc[:, 4:].head())
+
+
+if __name__ == '__main__':
+    main()